@@ -2,8 +2,16 @@
 from work_managers.serial import SerialWorkManager
 from nose.tools import assert_raises #@UnresolvedImport
 from .tsupport import *
+from work_managers import WMFuture
 
 class TestWMFuture:        
+    def test_task_ids_unique_ints(self):
+        futures = [WMFuture() for _n in range(3)]
+        task_ids = [future.task_id for future in futures]
+        assert all(isinstance(task_id, int) for task_id in task_ids)
+        assert len(set(task_ids)) == 3
+        assert WMFuture(task_id=0).task_id == 0
+        
     def test_result(self):
         with SerialWorkManager() as work_manager:
             future = work_manager.submit(will_succeed)
@@ -0,0 +1,224 @@
+
+import os, pickle, signal
+import numpy
+import zmq
+from nose.tools import assert_raises #@UnresolvedImport
+
+from work_managers.zeromq.core import ZMQCore, ZMQWMTimeout, Message, Task, Result, PassiveMultiTimer, pickle_frames, unpickle_frames, recv_frames, readable
+from work_managers.zeromq import core
+from test_work_managers.tsupport import identity
+
+from . import ZMQTestBase
+
+class TestZMQCoreFraming(ZMQTestBase):
+    '''Tests for the pickle/frame encoding used on every ZMQ socket.'''
+
+    def setUp(self):
+        super(TestZMQCoreFraming,self).setUp()
+
+        endpoint = 'inproc://{!s}-framing'.format(self.test_core.node_id)
+        self.send_socket = self.test_context.socket(zmq.PAIR)
+        self.send_socket.bind(endpoint)
+        self.recv_socket = self.test_context.socket(zmq.PAIR)
+        self.recv_socket.connect(endpoint)
+
+    def tearDown(self):
+        self.send_socket.close(linger=0)
+        self.recv_socket.close(linger=0)
+        super(TestZMQCoreFraming,self).tearDown()
+
+    def test_array_out_of_band(self):
+        frames = pickle_frames(numpy.arange(100000, dtype=numpy.float64))
+        assert len(frames) > 1
+
+    def test_small_object_single_frame(self):
+        assert len(pickle_frames(('ping', 1))) == 1
+
+    def test_array_roundtrip_writable(self):
+        a = numpy.arange(100000, dtype=numpy.float64)
+        self.send_socket.send_multipart(pickle_frames(a), copy=False)
+        frames = recv_frames(self.recv_socket)
+        assert all(isinstance(frame, zmq.Frame) for frame in frames[1:])
+        b = unpickle_frames(frames)
+        assert (b == a).all()
+        assert b.flags.writeable
+
+
+    def test_timed_recv(self):
+        assert_raises(ZMQWMTimeout, self.test_core.recv_message, self.recv_socket, timeout=10)
+        self.test_core.send_message(self.send_socket, Message.ACK)
+        assert self.test_core.recv_message(self.recv_socket, timeout=1000).message == Message.ACK
+
+    def test_undecodable_message_raises(self):
+        self.send_socket.send(b'not a pickle')
+        assert_raises(pickle.UnpicklingError, self.test_core.recv_message, self.recv_socket)
+
+    def test_undecodable_message_warns(self):
+        self.test_core.validation_fail_action = 'warn'
+        self.send_socket.send(b'not a pickle')
+        assert self.test_core.recv_message(self.recv_socket) is None
+
+    def test_recv_all_skips_undecodable(self):
+        self.test_core.validation_fail_action = 'warn'
+        self.send_socket.send(b'not a pickle')
+        self.test_core.send_message(self.send_socket, Message.ACK)
+        self.send_socket.send(b'not a pickle either')
+        readable(self.recv_socket, 1000)
+        msgs = self.test_core.recv_all(self.recv_socket)
+        assert [msg.message for msg in msgs] == [Message.ACK]
+
+
+class TestMessageCoalescing:
+    def test_coalesce_idempotent(self):
+        msgs = [Message(Message.TASKS_AVAILABLE) for _n in range(10)]
+        msgs.append(Message(Message.RECONFIGURE_TIMEOUT, ('a', 1)))
+        msgs.append(Message(Message.RECONFIGURE_TIMEOUT, ('b', 1)))
+        coalesced = Message.coalesce_announcements(msgs)
+        assert [msg.message for msg in coalesced].count(Message.TASKS_AVAILABLE) == 1
+        assert len(coalesced) == 3
+
+class TestZMQCoreInproc(ZMQTestBase):
+    def setUp(self):
+        super(TestZMQCoreInproc,self).setUp()
+        self.inproc_socket = self.test_context.socket(zmq.PULL)
+        self.inproc_socket.bind(self.test_core.inproc_endpoint)
+
+    def tearDown(self):
+        self.inproc_socket.close(linger=0)
+        super(TestZMQCoreInproc,self).tearDown()
+
+    def test_inproc_message_by_reference(self):
+        payload = numpy.arange(10)
+        self.test_core.send_inproc_message(Message.TASKS_AVAILABLE, payload)
+        assert self.inproc_socket.poll(1000)
+        msgs = self.test_core.recv_inproc_messages(self.inproc_socket)
+        assert len(msgs) == 1
+        assert msgs[0].message == Message.TASKS_AVAILABLE
+        assert msgs[0].payload is payload
+
+    def test_inproc_socket_reused(self):
+        for _n in range(3):
+            self.test_core.send_inproc_message(Message.TASKS_AVAILABLE)
+        assert len(self.test_core._inproc_sockets) == 1
+        assert self.inproc_socket.poll(1000)
+        assert len(self.test_core.recv_inproc_messages(self.inproc_socket)) == 3
+        self.test_core.close_inproc_sockets()
+
+    def test_signal_while_lock_held(self):
+        previous_handler = signal.signal(signal.SIGUSR1, self.test_core.shutdown_handler)
+        try:
+            with self.test_core._inproc_lock:
+                os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+            signal.signal(signal.SIGUSR1, previous_handler)
+        assert self.inproc_socket.poll(1000)
+        msgs = self.test_core.recv_inproc_messages(self.inproc_socket)
+        assert [msg.message for msg in msgs] == [Message.SHUTDOWN]
+
+    def test_unreceived_messages_released_on_close(self):
+        self.test_core.send_inproc_message(Message.TASKS_AVAILABLE, numpy.arange(10))
+        assert len(self.test_core._inproc_objects) == 1
+        self.test_core.close_inproc_sockets()
+        assert not self.test_core._inproc_objects
+
+
+class TestTaskPickling:
+    def test_task_roundtrip(self):
+        task = Task(identity, (1,), {'x': 2})
+        restored = unpickle_frames(pickle_frames(task))
+        assert restored.task_id == task.task_id
+        assert restored.fn is identity
+        assert restored.args == (1,)
+        assert restored.kwargs == {'x': 2}
+
+    def test_fn_pickle_cached(self):
+        fn_pickle = core.dumps_fn(identity)
+        assert core.dumps_fn(identity) is fn_pickle
+        assert core.loads_fn(fn_pickle) is identity
+
+class TestMessagePickling:
+    def test_message_roundtrip(self):
+        import uuid
+        msg = Message(Message.TASK, ('payload',), master_id=uuid.uuid4(), src_id=uuid.uuid4())
+        restored = unpickle_frames(pickle_frames(msg))
+        assert restored.message == msg.message
+        assert restored.payload == msg.payload
+        assert restored.master_id == msg.master_id
+        assert restored.src_id == msg.src_id
+
+    def test_message_roundtrip_no_ids(self):
+        restored = unpickle_frames(pickle_frames(Message(Message.SHUTDOWN)))
+        assert restored.master_id is None and restored.src_id is None
+class TestTaskFreezing:
+    def test_frozen_task_roundtrip(self):
+        a = numpy.arange(100000, dtype=numpy.float64)
+        task = Task(identity, (a,), {}).freeze()
+        frames = pickle_frames(task)
+        assert len(frames) > 1
+        restored = unpickle_frames(frames)
+        assert restored.task_id == task.task_id
+        assert restored.fn is identity
+        assert (restored.args[0] == a).all()
+
+    def test_frozen_task_relay(self):
+        a = numpy.arange(100000, dtype=numpy.float64)
+        task = Task(identity, (a,), {}).freeze()
+        relayed = unpickle_frames(pickle_frames(task))
+        assert 'args' not in relayed.__dict__
+        frames = pickle_frames(relayed)
+        assert len(frames) > 1
+        assert 'args' not in relayed.__dict__
+        restored = unpickle_frames(frames)
+        assert restored.task_id == task.task_id
+        assert restored.fn is identity
+        assert (restored.args[0] == a).all()
+
+    def test_frozen_task_snapshot(self):
+        args = [1]
+        task = Task(identity, args, {}).freeze()
+        args.append(2)
+        assert unpickle_frames(pickle_frames(task)).args == [1]
+
+class TestPassiveMultiTimer:
+    def test_remove_timer_reindexes(self):
+        timers = PassiveMultiTimer()
+        timers.add_timer('a', 0)
+        timers.add_timer('b', 3600)
+        timers.add_timer('c', 3600)
+        timers.remove_timer('a')
+        assert not timers.expired('b')
+        assert not timers.expired('c')
+        timers.change_duration('c', 0)
+        assert list(timers.which_expired()) == ['c']
+
+class TestIPCEndpoints:
+    def test_release_ipc_endpoint(self):
+        endpoint = ZMQCore.make_ipc_endpoint()
+        socket_path = endpoint[6:]
+        assert os.path.exists(socket_path)
+        ZMQCore.release_ipc_endpoint(endpoint)
+        assert not os.path.exists(socket_path)
+        assert endpoint not in ZMQCore._ipc_endpoints_to_delete
+
+    def test_release_ipc_endpoint_ignores_others(self):
+        ZMQCore.release_ipc_endpoint(None)
+        ZMQCore.release_ipc_endpoint('tcp://127.0.0.1:23811')
+
+class TestResultFreezing:
+    def test_frozen_result_relay(self):
+        a = numpy.arange(100000, dtype=numpy.float64)
+        result = Result(1, result={'a': a}).freeze()
+        relayed = unpickle_frames(pickle_frames(result))
+        frames = pickle_frames(relayed)
+        assert len(frames) > 1
+        assert 'result' not in relayed.__dict__
+        restored = unpickle_frames(frames)
+        assert restored.task_id == 1
+        assert restored.exception is None
+        assert (restored.result['a'] == a).all()
+
+    def test_unfrozen_result_roundtrip(self):
+        restored = unpickle_frames(pickle_frames(Result(1, exception=ValueError('x'), traceback='tb')))
+        assert isinstance(restored.exception, ValueError)
+        assert restored.traceback == 'tb'
+        assert restored.result is None
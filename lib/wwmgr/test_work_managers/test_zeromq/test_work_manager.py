@@ -6,8 +6,9 @@ Created on Jun 2, 2015
 
 
 import time
+from pickle import UnpicklingError
 from work_managers.zeromq import ZMQWorkManager, ZMQWorker, ZMQWorkerMissing
-from work_managers.zeromq.core import Message, Task
+from work_managers.zeromq.core import Message, Task, Result
 from test_work_managers.tsupport import *
 
 from contextlib import contextmanager
@@ -120,6 +121,9 @@ class TestZMQWorkManagerBasic(ZMQTestBase):
         self.test_core.recv_all(subsocket)
         subsocket.close(linger=0)        
             
+    def test_context_io_threads(self):
+        assert self.test_wm.context.get(zmq.IO_THREADS) == self.test_wm.io_threads
+    
     # Work manager shuts down on inproc signal
     def test_internal_shutdown(self):
         self.test_wm.signal_shutdown()
@@ -175,6 +179,56 @@ class TestZMQWorkManagerBasic(ZMQTestBase):
             self.test_core.send_message(s, Message.RESULT, result)
         assert future.result == r
 
+    def test_undecodable_result(self):
+        future = self.test_wm.submit(identity, (random_int(),))
+        with self.rr_socket() as s:
+            self.test_core.send_message(s,Message.TASK_REQUEST)
+            task = self.test_core.recv_message(s).payload
+            
+            # A result referring to a class the master cannot import
+            result = Result(task.task_id)
+            result._frozen = (b'\x80\x05cbuiltins\nno_such_class\n.', [])
+            self.test_core.send_message(s, Message.RESULT, result)
+            assert self.test_core.recv_message(s).message == Message.ACK
+        future.wait()
+        assert isinstance(future.get_exception(), UnpicklingError)
+        assert self.test_wm.comm_thread.is_alive()
+        
+    def test_undecodable_request_nak(self):
+        self.test_wm.validation_fail_action = 'warn'
+        with self.rr_socket() as s:
+            s.send(b'not a pickle')
+            msg = self.test_core.recv_message(s, timeout=1000)
+            assert msg.message == Message.NAK
+            
+            # Still serving requests
+            self.test_core.send_message(s, Message.WORKER_BEACON)
+            assert self.test_core.recv_message(s, timeout=1000).message == Message.ACK
+        assert self.test_wm.comm_thread.is_alive()
+        
+    def test_worker_beacon_ack(self):
+        with self.rr_socket() as s:
+            self.test_core.send_message(s, Message.WORKER_BEACON)
+            msg = self.test_core.recv_message(s)
+            assert msg.message == Message.ACK
+            
+    def test_expired_worker_task_requeued(self):
+        r = random_int()
+        future = self.test_wm.submit(identity, (r,))
+        with self.rr_socket() as s:
+            self.test_core.send_message(s,Message.TASK_REQUEST)
+            task = self.test_core.recv_message(s).payload
+            
+            # As if the worker had gone silent
+            self.test_wm.remove_worker(self.test_core.node_id)
+            
+            self.test_core.send_message(s,Message.TASK_REQUEST)
+            msg = self.test_core.recv_message(s)
+            assert msg.message == Message.TASK
+            assert msg.payload.task_id == task.task_id
+            self.test_core.send_message(s, Message.RESULT, msg.payload.execute())
+        assert future.result == r
+
 class BaseInternal(ZMQTestBase,CommonWorkManagerTests):
     def setUp(self):
         super(BaseInternal,self).setUp()
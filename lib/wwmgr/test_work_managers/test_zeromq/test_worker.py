@@ -1,12 +1,13 @@
 
-import time
+import time, os, signal
 from work_managers.zeromq import ZMQWorker
-from work_managers.zeromq.core import Message, Task, Result, TIMEOUT_MASTER_BEACON
+from work_managers.zeromq.core import Message, Task, Result, TIMEOUT_MASTER_BEACON, ZMQWorkerMissing, ZMQWMTimeout
 from test_work_managers.tsupport import *
 
 from contextlib import contextmanager
 
 import zmq
+import numpy
 
 import nose.tools
 from nose.tools import raises, nottest, timed, assert_raises #@UnresolvedImport
@@ -94,6 +95,43 @@ class TestZMQWorkerBasic(ZMQTestBase):
         self.test_core.send_nak(self.rr_socket,msg)
         assert msg.message == Message.TASK_REQUEST
         
+    def test_worker_beacon(self):
+        self.test_core.send_message(self.ann_socket, Message.MASTER_BEACON)
+        msg = self.test_core.recv_message(self.rr_socket)
+        self.test_core.send_ack(self.rr_socket,msg)
+        assert msg.message == Message.IDENTIFY
+        self.test_core.send_message(self.ann_socket, Message.RECONFIGURE_TIMEOUT, ('worker_beacon', 0.05))
+        msg = self.test_core.recv_message(self.rr_socket, timeout=1000)
+        self.test_core.send_ack(self.rr_socket,msg)
+        assert msg.message == Message.WORKER_BEACON
+        assert msg.payload is None
+        
+    def expect_failed_task(self, exception_type):
+        old_pid = self.test_worker.executor_process.pid
+        
+        # Reported at the next worker beacon
+        self.test_core.send_message(self.ann_socket, Message.RECONFIGURE_TIMEOUT, ('worker_beacon', 0.05))
+        msg = self.test_core.recv_message(self.rr_socket, timeout=2000)
+        self.test_core.send_ack(self.rr_socket,msg)
+        assert msg.message == Message.RESULT
+        assert isinstance(msg.payload.exception, exception_type)
+        
+        # ...by which time a fresh executor has been started
+        assert self.test_worker.executor_process.pid != old_pid
+        assert self.test_worker.executor_process.is_alive()
+        
+    def test_executor_death_reported(self):
+        self.send_task(Task(will_hang, (), {}))
+        time.sleep(0.1)
+        os.kill(self.test_worker.executor_process.pid, signal.SIGKILL)
+        self.expect_failed_task(ZMQWorkerMissing)
+        
+    def test_task_timeout(self):
+        self.test_worker.task_timeout = 0.1
+        self.send_task(Task(will_busyhang_uninterruptible, (), {}))
+        time.sleep(0.2)
+        self.expect_failed_task(ZMQWMTimeout)
+        
     def test_shutdown_on_master_disappearance(self):
         self.test_core.send_message(self.ann_socket, Message.RECONFIGURE_TIMEOUT, (TIMEOUT_MASTER_BEACON, 0.01))
         time.sleep(0.02)
@@ -106,6 +144,12 @@ class TestZMQWorkerBasic(ZMQTestBase):
         rsl = self.roundtrip_task(task) 
         assert rsl.result == r
                 
+    def test_worker_processes_array_task(self):
+        a = numpy.arange(100000, dtype=numpy.float64)
+        task = Task(identity, (a,), {})
+        rsl = self.roundtrip_task(task)
+        assert (rsl.result == a).all()
+                
     def test_worker_processes_exception(self):
         task = Task(will_fail, (), {})
         rsl = self.roundtrip_task(task)
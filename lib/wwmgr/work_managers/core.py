@@ -4,12 +4,20 @@
 # Foundation. See http://docs.python.org/3/license.html for more information.
 
 import logging
-import uuid, threading, signal
+import threading, signal
 import h5py
-from itertools import islice
+from itertools import islice, count
 from contextlib import contextmanager
 log = logging.getLogger(__name__)
 
+# Task IDs are small integers, unique within the process that creates them (the
+# master); they are cheaper to hash and to pickle than UUIDs.
+_task_ids = count()
+
+def next_task_id():
+    '''Return a new task ID.'''
+    return next(_task_ids)
+
 class WorkManager:
     '''Base class for all work managers. At a minimum, work managers must provide a 
     ``submit()`` function and a ``n_workers`` attribute (which may be a property),
@@ -225,7 +233,7 @@ class WMFuture:
             future._condition.release()
     
     def __init__(self, task_id=None):
-        self.task_id = task_id or uuid.uuid4()
+        self.task_id = task_id if task_id is not None else next_task_id()
 
         self._condition = threading.Condition()
         self._done = False
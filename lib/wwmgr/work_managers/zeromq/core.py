@@ -4,6 +4,7 @@ Created on May 29, 2015
 @author: mzwier
 '''
 
+import pickle
 from pickle import UnpicklingError
 
 # Every ten seconds the master requests a status report from workers.
@@ -20,6 +21,7 @@ log = logging.getLogger(__name__)
 
 #import gevent
 import sys, uuid, socket, os,tempfile, errno, time, threading, contextlib, traceback, multiprocessing, json, re
+import itertools, struct, types, weakref
 from collections import OrderedDict
 
 import signal
@@ -29,8 +31,15 @@ signames = {val:name for name, val in reversed(sorted(signal.__dict__.items()))
 import zmq
 import numpy
 
+from work_managers.core import next_task_id
+
 DEFAULT_LINGER = 1
 
+# Messages are pickled with protocol 5, so that large contiguous buffers (e.g. the
+# contents of NumPy arrays) travel as separate ZeroMQ frames rather than being
+# copied into the pickle stream.
+PICKLE_PROTOCOL = 5
+
 def randport(address='127.0.0.1'):
     '''Select a random unused TCP port number on the given address.''' 
     s = socket.socket()
@@ -41,6 +50,53 @@ def randport(address='127.0.0.1'):
         s.close()
     return port
 
+def pickle_frames(obj):
+    '''Pickle ``obj``, returning a list of frames suitable for ``send_multipart()``.
+    The first frame is the pickle stream; remaining frames are out-of-band buffers.'''
+    buffers = []
+    frames = [pickle.dumps(obj, protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append)]
+    frames.extend(buffer.raw() for buffer in buffers)
+    return frames
+
+def recv_frames(socket, flags=0):
+    '''Receive a message produced by ``pickle_frames()``. The (usually small) pickle
+    stream is copied; out-of-band buffers are received without copying.'''
+    frames = [socket.recv(flags)]
+    while socket.getsockopt(zmq.RCVMORE):
+        frames.append(socket.recv(copy=False))
+    return frames
+
+def readable(socket, timeout=0):
+    '''Return true if a message can be received from ``socket`` without blocking,
+    waiting up to ``timeout`` milliseconds for one to arrive.
+    Draining loops use this rather than a non-blocking receive, which signals an
+    empty socket by raising (and constructing) a zmq.Again exception. (A zero-timeout
+    zmq_poll() is also about twice as fast as reading ``zmq.EVENTS``.)'''
+    return zmq.zmq_poll([(socket, zmq.POLLIN)], timeout)
+
+def unpickle_frames(frames):
+    '''Reconstruct an object from frames produced by ``pickle_frames()``.'''
+    return pickle.loads(frames[0], buffers=frames[1:])
+
+# Messages between threads of one process travel by reference: the object
+# is parked in a dictionary shared by sender and receiver, and only its integer
+# key crosses the inproc:// socket.
+_inproc_object_keys = itertools.count()
+_inproc_key_format = struct.Struct('Q')
+
+def send_reference(socket, obj, parked, flags=0):
+    '''Send ``obj`` by reference over an inproc:// socket, parking it in the 
+    dictionary ``parked``. The receiving thread must be in this process and must call
+    ``recv_reference()`` with the same dictionary.'''
+    key = next(_inproc_object_keys)
+    parked[key] = obj
+    socket.send(_inproc_key_format.pack(key), flags)
+
+def recv_reference(socket, parked, flags=0):
+    '''Receive an object sent with ``send_reference()``.'''
+    (key,) = _inproc_key_format.unpack(socket.recv(flags))
+    return parked.pop(key)
+
 class ZMQWMError(RuntimeError):
     '''Base class for errors related to the ZeroMQ work manager itself'''
     pass
@@ -56,6 +112,11 @@ class ZMQWMEnvironmentError(ZMQWMError):
 class ZMQWMTimeout(ZMQWMEnvironmentError):
     '''A timeout of a sort that indicatess that a master or worker has failed or never started.'''
 
+def _restore_message(message, payload, master_id, src_id):
+    return Message(message, payload, 
+                   master_id = uuid.UUID(bytes=master_id) if master_id is not None else None,
+                   src_id = uuid.UUID(bytes=src_id) if src_id is not None else None)
+
 class Message:
     SHUTDOWN = 'shutdown'
     
@@ -67,6 +128,7 @@ class Message:
     
     
     MASTER_BEACON = 'master_alive'
+    WORKER_BEACON = 'worker_alive' # payload is the ID of the task the worker is running, if any
     RECONFIGURE_TIMEOUT = 'reconfigure_timeout'    
     
     TASK = 'task'
@@ -91,6 +153,13 @@ class Message:
     def __repr__(self):
         return ('<{!s} master_id={master_id!s} src_id={src_id!s} message={message!r} payload={payload!r}>'
                 .format(self.__class__.__name__, **self.__dict__))
+    
+    def __reduce__(self):
+        # Pickle as a flat tuple, with IDs as 16 raw bytes; pickling the UUID objects
+        # themselves costs a class reference and an attribute dict each
+        return (_restore_message, (self.message, self.payload,
+                                   self.master_id.bytes if self.master_id is not None else None,
+                                   self.src_id.bytes if self.src_id is not None else None))
         
         
     @classmethod
@@ -102,31 +171,111 @@ class Message:
             else:
                 key = (msg.message, msg.payload)
             d[key] = msg
-        coalesced = list(msg.values())
+        coalesced = list(d.values())
         log.debug('coalesced {} announcements into {}'.format(len(messages), len(coalesced)))
         return coalesced
 
 TIMEOUT_MASTER_BEACON = 'master_beacon'
 TIMEOUT_WORKER_CONTACT = 'worker_contact'
                
+# Pickled forms of task functions, so that submitting the same function many times
+# pickles it only once. Only plain functions are cached; they pickle by reference
+# and so cannot go stale (a bound method, by contrast, pickles its instance's state).
+_fn_pickles = weakref.WeakKeyDictionary()
+_cacheable_fn_types = (types.FunctionType, types.BuiltinFunctionType)
+
+# Functions unpickled in this process, keyed by their pickled form
+_fn_unpickles = {}
+_fn_unpickles_max = 64
+
+def dumps_fn(fn):
+    '''Pickle the task function ``fn``, reusing a cached pickle where possible.'''
+    if not isinstance(fn, _cacheable_fn_types):
+        return pickle.dumps(fn, protocol=PICKLE_PROTOCOL)
+    try:
+        return _fn_pickles[fn]
+    except KeyError:
+        fn_pickle = _fn_pickles[fn] = pickle.dumps(fn, protocol=PICKLE_PROTOCOL)
+        return fn_pickle
+    except TypeError:
+        # not weak-referenceable
+        return pickle.dumps(fn, protocol=PICKLE_PROTOCOL)
+
+def loads_fn(fn_pickle):
+    '''Unpickle a task function pickled by ``dumps_fn()``, reusing functions already
+    unpickled in this process.'''
+    try:
+        return _fn_unpickles[fn_pickle]
+    except KeyError:
+        fn = pickle.loads(fn_pickle)
+        if isinstance(fn, _cacheable_fn_types):
+            if len(_fn_unpickles) >= _fn_unpickles_max:
+                _fn_unpickles.clear()
+            _fn_unpickles[fn_pickle] = fn
+        return fn
+
+def _restore_task(task_id, fn_pickle, args, kwargs):
+    return Task(loads_fn(fn_pickle), args, kwargs, task_id)
+
+def _thaw_task(task_id, blob, buffers):
+    # The function and arguments are left frozen until first used (see Task.__getattr__)
+    task = Task.__new__(Task)
+    task.task_id = task_id
+    task._frozen = (blob, buffers)
+    return task
+
 class Task:
     def __init__(self, fn, args, kwargs, task_id = None):
-        self.task_id = task_id or uuid.uuid4()
+        self.task_id = task_id if task_id is not None else next_task_id()
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        
+        # Pickled form of this task, as produced by freeze()
+        self._frozen = None
+                
+    def __getattr__(self, name):
+        # Only called for attributes not yet set, i.e. the function and arguments of a
+        # task received in frozen form. Unpickling them is deferred to here so that a 
+        # process that only passes a task on (a worker relaying to its executor) never
+        # unpickles them at all.
+        frozen = self.__dict__.get('_frozen')
+        if name not in ('fn', 'args', 'kwargs') or frozen is None:
+            raise AttributeError(name)
+        blob, buffers = frozen
+        fn_pickle, self.args, self.kwargs = pickle.loads(blob, buffers=buffers)
+        self.fn = loads_fn(fn_pickle)
+        return self.__dict__[name]
                 
     def __repr__(self):
         try:
-            return '<{} {task_id!s} {fn!r} {:d} args {:d} kwargs>'\
-                   .format(self.__class__.__name__, len(self.args), len(self.kwargs), **self.__dict__)
+            return '<{} {!s} {!r} {:d} args {:d} kwargs>'\
+                   .format(self.__class__.__name__, self.task_id, self.fn, len(self.args), len(self.kwargs))
         except TypeError:
             # no length
-            return '<{} {task_id!s} {fn!r}'.format(self.__class__.__name__, **self.__dict__)
+            return '<{} {!s} {!r}'.format(self.__class__.__name__, self.task_id, self.fn)
                
     def __hash__(self):
         return hash(self.task_id)
     
+    def freeze(self):
+        '''Pickle this task now, in the calling thread, so that sending it later
+        only copies bytes into the message pickle. Large buffers among the arguments
+        are kept out of band (and so are not copied here either).'''
+        if self._frozen is None:
+            buffers = []
+            blob = pickle.dumps((dumps_fn(self.fn), self.args, self.kwargs), 
+                                protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append)
+            self._frozen = (blob, buffers)
+        return self
+    
+    def __reduce__(self):
+        if self._frozen is not None:
+            blob, buffers = self._frozen
+            # Received buffers are zmq.Frames, which must be wrapped to stay out of band
+            return (_thaw_task, (self.task_id, blob, [pickle.PickleBuffer(buffer) for buffer in buffers]))
+        return (_restore_task, (self.task_id, dumps_fn(self.fn), self.args, self.kwargs))
+    
     def execute(self):
         '''Run this task, returning a Result object.'''
         rsl = Result(task_id = self.task_id)
@@ -138,6 +287,13 @@ class Task:
         return rsl
         
     
+def _thaw_result(task_id, blob, buffers):
+    # As for tasks, the contents are left frozen until first used (see Result.__getattr__)
+    result = Result.__new__(Result)
+    result.task_id = task_id
+    result._frozen = (blob, buffers)
+    return result
+
 class Result:
     def __init__(self, task_id, result=None, exception=None, traceback=None):
         self.task_id = task_id
@@ -145,12 +301,45 @@ class Result:
         self.exception = exception
         self.traceback = traceback
         
+        # Pickled form of this result, as produced by freeze()
+        self._frozen = None
+        
+    def __getattr__(self, name):
+        # Only called for the contents of a result received in frozen form, so that
+        # a worker relaying the result from its executor never unpickles them
+        frozen = self.__dict__.get('_frozen')
+        if name not in ('result', 'exception', 'traceback') or frozen is None:
+            raise AttributeError(name)
+        blob, buffers = frozen
+        try:
+            self.result, self.exception, self.traceback = pickle.loads(blob, buffers=buffers)
+        except Exception as e:
+            # Re-raised so that, in particular, an AttributeError from unpickling (a class
+            # unknown here) is not taken for a missing attribute
+            raise UnpicklingError('could not decode result of task {!s}: {!s}'.format(self.task_id, e)) from e
+        return self.__dict__[name]
+        
     def __repr__(self):
-        return '<{} {task_id!s} ({})>'\
-               .format(self.__class__.__name__, 'result' if self.exception is None else 'exception', **self.__dict__)
+        return '<{} {!s} ({})>'\
+               .format(self.__class__.__name__, self.task_id, 'result' if self.exception is None else 'exception')
                
     def __hash__(self):
         return hash(self.task_id)
+    
+    def freeze(self):
+        '''Pickle the contents of this result now; see ``Task.freeze()``.'''
+        if self._frozen is None:
+            buffers = []
+            blob = pickle.dumps((self.result, self.exception, self.traceback),
+                                protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append)
+            self._frozen = (blob, buffers)
+        return self
+    
+    def __reduce__(self):
+        if self._frozen is not None:
+            blob, buffers = self._frozen
+            return (_thaw_result, (self.task_id, blob, [pickle.PickleBuffer(buffer) for buffer in buffers]))
+        return (Result, (self.task_id, self.result, self.exception, self.traceback))
    
 
 class PassiveTimer:
@@ -202,6 +391,10 @@ class PassiveMultiTimer:
         self._durations = numpy.delete(self._durations, idx)
         self._started = numpy.delete(self._started, idx)
         self._identifiers = numpy.delete(self._identifiers, idx)
+        # Timers after the removed one have moved down by one
+        for identifier, other_idx in self._indices.items():
+            if other_idx > idx:
+                self._indices[identifier] = other_idx - 1
         
     def change_duration(self, identifier, duration):
         idx = self._indices[identifier]
@@ -265,32 +458,50 @@ class ZMQCore:
     default_timeout_factor = 5.0
     default_startup_timeout = 120.0
     default_shutdown_timeout = 5.0
+    
+    # libzmq I/O threads for the contexts of the master and nodes, which exchange
+    # traffic with many workers at once; workers and executors use one
+    default_io_threads = min(4, multiprocessing.cpu_count())
         
     
     
-    _ipc_endpoints_to_delete = []
+    # IPC endpoints created by make_ipc_endpoint() and not yet removed
+    _ipc_endpoints_to_delete = set()
     
     @classmethod    
     def make_ipc_endpoint(cls):
         (fd, socket_path) = tempfile.mkstemp()
         os.close(fd)
         endpoint = 'ipc://{}'.format(socket_path)
-        cls._ipc_endpoints_to_delete.append(endpoint)
+        cls._ipc_endpoints_to_delete.add(endpoint)
         return endpoint
     
+    @staticmethod
+    def _unlink_ipc_endpoint(endpoint):
+        assert endpoint.startswith('ipc://')
+        socket_path = endpoint[6:]
+        try:
+            os.unlink(socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.debug('could not unlink IPC endpoint {!r}: {}'.format(socket_path, e))
+        else:
+            log.debug('unlinked IPC endpoint {!r}'.format(socket_path))
+    
+    @classmethod
+    def release_ipc_endpoint(cls, endpoint):
+        '''Remove ``endpoint`` if it was created by ``make_ipc_endpoint()`` and has not
+        been removed already; any other endpoint (including None) is ignored.'''
+        try:
+            cls._ipc_endpoints_to_delete.remove(endpoint)
+        except KeyError:
+            return
+        cls._unlink_ipc_endpoint(endpoint)
+    
     @classmethod
     def remove_ipc_endpoints(cls):
         while cls._ipc_endpoints_to_delete:
-            endpoint = cls._ipc_endpoints_to_delete.pop()
-            assert endpoint.startswith('ipc://')
-            socket_path = endpoint[6:]
-            try:
-                os.unlink(socket_path)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    log.debug('could not unlink IPC endpoint {!r}: {}'.format(socket_path, e))
-            else:
-                log.debug('unlinked IPC endpoint {!r}'.format(socket_path))
+            cls._unlink_ipc_endpoint(cls._ipc_endpoints_to_delete.pop())
                 
     @classmethod
     def make_tcp_endpoint(cls, address='127.0.0.1'):
@@ -343,6 +554,7 @@ class ZMQCore:
         
         # ZeroMQ context
         self.context = None
+        self.io_threads = self.default_io_threads
         
         # External communication endpoints
         self.rr_endpoint = None
@@ -354,8 +566,16 @@ class ZMQCore:
         self.rr_socket = None
         self.ann_socket = None
         
-        # This is the main-thread end of this
-        self._inproc_socket = None
+        # Sending ends of inproc endpoints, created on first use and kept open (indexed
+        # by endpoint); guarded by a lock since signals may come from any thread. The lock
+        # is reentrant because shutdown_handler() runs in the main thread, possibly while
+        # that same thread is inside send_inproc_message() (e.g. via submit()).
+        self._inproc_sockets = {}
+        self._inproc_lock = threading.RLock()
+        
+        # Messages sent by send_inproc_message() and not yet received, indexed by key;
+        # anything left over when the communication loop exits is dropped with the sockets
+        self._inproc_objects = {}
         
         self.master_id = None
         
@@ -416,21 +636,25 @@ class ZMQCore:
         Message validation is performed if ``validate`` is true.
         If ``timeout`` is given, then it is the number of milliseconds to wait
         prior to raising a ZMQWMTimeout exception. ``timeout`` is ignored if
-        ``flags`` includes ``zmq.NOBLOCK``.'''
+        ``flags`` includes ``zmq.NOBLOCK``. A message that cannot be decoded at all
+        is subject to ``validation_fail_action``; when that is 'warn', None is returned.'''
         
         if timeout is None or flags & zmq.NOBLOCK:
-            message = socket.recv_pyobj(flags)
-        else:        
-            poller = zmq.Poller()
-            poller.register(socket, zmq.POLLIN)
-            try:
-                poll_results = dict(poller.poll(timeout=timeout))
-                if socket in poll_results:
-                    message = socket.recv_pyobj(flags)
-                else:
-                    raise ZMQWMTimeout('recv timed out')
-            finally:
-                poller.unregister(socket)
+            frames = recv_frames(socket, flags)
+        else:
+            if readable(socket, timeout):
+                frames = recv_frames(socket, flags)
+            else:
+                raise ZMQWMTimeout('recv timed out')
+        
+        try:
+            message = unpickle_frames(frames)
+        except Exception as e:
+            # Not a pickle at all, or one referring to something not importable here;
+            # subject to the same policy as any other invalid message
+            with self.message_validation(bytes(frames[0][:64])):
+                raise UnpicklingError('could not decode message: {!s}'.format(e)) from e
+            return None
         
         if self._super_debug:
             self.log.debug('received {!r}'.format(message))
@@ -442,15 +666,15 @@ class ZMQCore:
     def recv_all(self, socket, flags=0, validate=True):
         '''Receive all messages currently available from the given socket.'''
         messages = []
-        while True:
-            try:
-                messages.append(self.recv_message(socket, flags | zmq.NOBLOCK, validate))
-            except zmq.Again:
-                return messages
+        while readable(socket):
+            msg = self.recv_message(socket, flags | zmq.NOBLOCK, validate)
+            if msg is not None:
+                messages.append(msg)
+        return messages
             
     def recv_ack(self, socket, flags=0, validate=True, timeout=None):
         msg = self.recv_message(socket, flags, validate, timeout)
-        if validate:
+        if validate and msg is not None:
             with self.message_validation(msg):
                 assert msg.message in (Message.ACK, Message.NAK)
         return msg
@@ -469,7 +693,7 @@ class ZMQCore:
         
         if self._super_debug:
             self.log.debug('sending {!r}'.format(message))
-        socket.send_pyobj(message,flags)
+        socket.send_multipart(pickle_frames(message), flags, copy=False)
                     
     def send_reply(self, socket, original_message, reply=Message.ACK, payload=None,flags=0):
         '''Send a reply to ``original_message`` on ``socket``. The reply message
@@ -496,12 +720,49 @@ class ZMQCore:
                                           src_id=self.node_id))
 
     def send_inproc_message(self, message, payload=None, flags=0):
-        inproc_socket = self.context.socket(zmq.PUB)
-        inproc_socket.connect(self.inproc_endpoint)
-        # annoying wait for sockets to settle
-        time.sleep(0.01)
-        self.send_message(inproc_socket, message, payload, flags)
-        # used to be a close with linger here, but it was cutting off messages
+        '''Send a message to this object's communication thread. The message is
+        passed by reference rather than pickled; see ``recv_inproc_messages()``.'''
+        message = Message(message, payload)
+        if message.master_id is None:
+            message.master_id = self.master_id
+        message.src_id = self.node_id
+        
+        if self._super_debug:
+            self.log.debug('sending {!r} by reference'.format(message))
+        with self._inproc_lock:
+            if self._inproc_sockets is None:
+                # the communication loop has exited
+                return
+            try:
+                inproc_socket = self._inproc_sockets[self.inproc_endpoint]
+            except KeyError:
+                # PUSH/PULL rather than PUB/SUB, because a PUB socket drops messages
+                # sent before its subscriptions settle, which would strand parked messages
+                inproc_socket = self._inproc_sockets[self.inproc_endpoint] = self.context.socket(zmq.PUSH)
+                inproc_socket.connect(self.inproc_endpoint)
+            send_reference(inproc_socket, message, self._inproc_objects, flags)
+    
+    def close_inproc_sockets(self):
+        '''Close the sockets used by ``send_inproc_message()``. This must happen before
+        the context is destroyed; after it, signals are silently dropped.'''
+        with self._inproc_lock:
+            for inproc_socket in self._inproc_sockets.values():
+                inproc_socket.close(linger=DEFAULT_LINGER)
+            self._inproc_sockets = None
+            # Keys still queued will never be received; release what they refer to
+            self._inproc_objects.clear()
+        
+    def recv_inproc_messages(self, socket, validate=True):
+        '''Receive all messages currently available from the given inproc socket, 
+        as sent by ``send_inproc_message()``.'''
+        messages = []
+        while readable(socket):
+            message = recv_reference(socket, self._inproc_objects, zmq.NOBLOCK)
+            if validate:
+                with self.message_validation(message):
+                    self.validate_message(message)
+            messages.append(message)
+        return messages
         
     def signal_shutdown(self):
         try:
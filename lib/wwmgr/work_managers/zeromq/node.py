@@ -36,8 +36,10 @@ class ZMQNode(ZMQCore,IsNode):
         
         
     def comm_loop(self):
-        self.context = zmq.Context.instance() 
+        self.context = zmq.Context.instance(io_threads=self.io_threads) 
         # or else the proxies create sockets in a different context
+        # (io_threads only takes effect if this is the first call to instance()
+        # in this process, which it is unless something else already created it)
          
         self.context.linger = 100
         # So we don't have to destroy the context at the end of the loop
@@ -78,8 +80,7 @@ class ZMQNode(ZMQCore,IsNode):
         
         ann_monitor.connect(ann_mon_endpoint)
         
-        inproc_socket = self.context.socket(zmq.SUB)
-        inproc_socket.setsockopt(zmq.SUBSCRIBE,b'')
+        inproc_socket = self.context.socket(zmq.PULL)
         inproc_socket.bind(self.inproc_endpoint)
         
         timers = PassiveMultiTimer()
@@ -97,15 +98,15 @@ class ZMQNode(ZMQCore,IsNode):
         poller.register(inproc_socket, zmq.POLLIN)
         try:
             while True:
-                poll_results = dict(poller.poll((timers.next_expiration_in() or 0.001)*1000))
+                poll_results = poller.poll((timers.next_expiration_in() or 0.001)*1000)
                 
-                if inproc_socket in poll_results:
-                    msgs = self.recv_all(ann_monitor,validate=False)
+                if (inproc_socket, zmq.POLLIN) in poll_results:
+                    msgs = self.recv_inproc_messages(inproc_socket,validate=False)
                     if Message.SHUTDOWN in (msg.message for msg in msgs):
                         self.log.debug('shutdown received')
                         break                    
                 
-                if ann_monitor in poll_results:
+                if (ann_monitor, zmq.POLLIN) in poll_results:
                     msgs = self.recv_all(ann_monitor,validate=False)
                     message_tags = {msg.message for msg in msgs}
                     if Message.SHUTDOWN in message_tags:
@@ -114,7 +115,11 @@ class ZMQNode(ZMQCore,IsNode):
                     if not peer_found and (Message.MASTER_BEACON in message_tags or Message.TASKS_AVAILABLE in message_tags):
                         peer_found = True
                         timers.remove_timer('startup_timeout')
-                        
+                
+                # Nothing to do on this timer but wake up periodically; if it is left
+                # expired, poll() returns immediately from then on
+                if timers.expired('master_beacon'):
+                    timers.reset('master_beacon')
                         
                 if not peer_found and timers.expired('startup_timeout'):
                     self.log.error('startup phase elapsed with no contact from peer; shutting down')
@@ -122,8 +127,10 @@ class ZMQNode(ZMQCore,IsNode):
             
         finally:
             self.log.debug('exiting')
+            self.close_inproc_sockets()
             self.context = None
-            self.remove_ipc_endpoints()
+            self.release_ipc_endpoint(self.local_rr_endpoint)
+            self.release_ipc_endpoint(self.local_ann_endpoint)
             IsNode.shutdown(self)
 
     def startup(self):
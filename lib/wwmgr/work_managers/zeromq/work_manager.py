@@ -8,7 +8,7 @@ import logging
 log = logging.getLogger(__name__)
 
 from .core import ZMQCore, Message, Task, Result, ZMQWorkerMissing, ZMQWMEnvironmentError, IsNode
-from .core import randport
+from .core import randport, pickle_frames
 from .worker import ZMQWorker
 from .node import ZMQNode
 import work_managers
@@ -21,7 +21,7 @@ import zmq
 
 from collections import deque
 
-import socket, re, json
+import socket, re, json, threading
 
 class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
     
@@ -89,6 +89,15 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                                   +'on very large, heavily-loaded computer systems that start all processes '
                                   +'simultaneously. '
                                   )
+        wm_group.add_argument(wmenv.arg_flag('zmq_task_timeout'), metavar='TASK_TIMEOUT',
+                              type=float,
+                              help='Kill (and report as failed) any task running for longer than '
+                                  +'TASK_TIMEOUT seconds. This is checked every WORKER_HEARTBEAT '
+                                  +'seconds. (Default: no limit.)')
+        wm_group.add_argument(wmenv.arg_flag('zmq_io_threads'), metavar='N_IO_THREADS',
+                              type=int,
+                              help='Number of ZeroMQ I/O threads used by the master or node for '
+                                  +'communication with workers (default: the number of cores, up to 4).')
         wm_group.add_argument(wmenv.arg_flag('zmq_shutdown_timeout'), metavar='SHUTDOWN_TIMEOUT', 
                               type=float,
                               help='Amount of time (in seconds) to wait for workers to shut down.')
@@ -126,6 +135,10 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         worker_heartbeat = wmenv.get_val('zmq_worker_heartbeat', cls.default_worker_heartbeat, float)
         timeout_factor = wmenv.get_val('zmq_timeout_factor', cls.default_timeout_factor, float)
         startup_timeout = wmenv.get_val('zmq_startup_timeout', cls.default_startup_timeout, float)
+        io_threads = wmenv.get_val('zmq_io_threads', cls.default_io_threads, int)
+        task_timeout = wmenv.get_val('zmq_task_timeout')
+        if task_timeout is not None:
+            task_timeout = float(task_timeout)
         
         
         if mode == 'master':
@@ -170,6 +183,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         instance.worker_beacon_period = worker_heartbeat
         instance.timeout_factor = timeout_factor
         instance.startup_timeout = startup_timeout
+        instance.io_threads = io_threads
         
         assert isinstance(instance, IsNode)
         for worker in instance.local_workers:
@@ -177,6 +191,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             worker.worker_beacon_period = worker_heartbeat
             worker.timeout_factor = timeout_factor
             worker.startup_timeout = startup_timeout
+            worker.task_timeout = task_timeout
         
         # We always write host info (since we are always either master or node)
         # we choose not to in the special case that read_host_info is '' but not None
@@ -187,7 +202,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
 
         log.debug('prepared {!r} with:'.format(instance))
         log.debug('n_workers = {}'.format(n_workers))
-        for attr in ('master_beacon_period', 'worker_beacon_period', 'startup_timeout', 'timeout_factor',
+        for attr in ('master_beacon_period', 'worker_beacon_period', 'startup_timeout', 'timeout_factor', 'io_threads',
                      'downstream_rr_endpoint', 'downstream_ann_endpoint'):
             log.debug('{} = {!r}'.format(attr, getattr(instance, attr)))
                 
@@ -236,12 +251,18 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         # Futures indexed by task ID
         self.futures = dict()
         
-        # Tasks pending distribution
+        # Tasks pending distribution (touched only by the communication thread)
         self.outgoing_tasks = deque()
         
         # Tasks being processed by workers (indexed by worker_id)
         self.assigned_tasks = dict()
         
+        # IDs of tasks already requeued once after their worker disappeared
+        self.requeued_task_ids = set()
+        
+        # Pickled announcements, indexed by message identifier (see send_announcement())
+        self._announcement_frames = dict()
+        
         # Identity information and last contact from workers
         self.worker_information = dict() # indexed by worker_id
         self.worker_timeouts = PassiveMultiTimer() # indexed by worker_id
@@ -263,35 +284,60 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             # We are shutting down
             raise ZMQWMEnvironmentError('work manager is shutting down')
         future = WMFuture()
-        task = Task(fn, args or (), kwargs or {}, task_id = future.task_id)
+        # Pickle in the caller's thread rather than in the communications loop
+        task = Task(fn, args or (), kwargs or {}, task_id = future.task_id).freeze()
         self.futures[task.task_id] = future
-        self.outgoing_tasks.append(task)
-        # Wake up the communications loop (if necessary) to announce new tasks
-        self.send_inproc_message(Message.TASKS_AVAILABLE)
+        self.post_tasks([task])
         return future
 
     def submit_many(self, tasks):
         if self.futures is None:
             # We are shutting down
             raise ZMQWMEnvironmentError('work manager is shutting down')
-        futures = []        
+        futures = []
+        new_tasks = []
         for (fn,args,kwargs) in tasks:
             future = WMFuture()
-            task = Task(fn, args, kwargs, task_id = future.task_id)
+            task = Task(fn, args, kwargs, task_id = future.task_id).freeze()
             self.futures[task.task_id] = future
-            self.outgoing_tasks.append(task)
+            new_tasks.append(task)
             futures.append(future)
-        # Wake up the communications loop (if necessary) to announce new tasks            
-        self.send_inproc_message(Message.TASKS_AVAILABLE)
+        self.post_tasks(new_tasks)
         return futures
+    
+    def post_tasks(self, tasks):
+        '''Hand a list of new tasks to the communications loop, which queues and announces them.'''
+        if self.context is None:
+            # Communications loop not (or no longer) running
+            self.outgoing_tasks.extend(tasks)
+        else:
+            # Shares the inproc channel (and the single poller) used for shutdown signals
+            self.send_inproc_message(Message.TASKS_AVAILABLE, tasks)
 
     def send_message(self, socket, message, payload=None, flags=0):
         message = Message(message, payload)
         message.master_id = self.node_id
         super(ZMQWorkManager,self).send_message(socket, message, payload, flags)
         
+    def send_announcement(self, socket, message, flags=0):
+        '''Send an announcement (e.g. a beacon) with no payload. Such messages are the
+        same every time, so each is pickled once and the result reused.'''
+        try:
+            frame = self._announcement_frames[message]
+        except KeyError:
+            [frame] = pickle_frames(Message(message, master_id=self.node_id, src_id=self.node_id))
+            self._announcement_frames[message] = frame
+        socket.send(frame, flags)
+        
     def handle_result(self, socket, msg):
         self.send_ack(socket,msg)
+        
+        if msg.src_id not in self.assigned_tasks:
+            # A worker we gave up on (see remove_worker()) finished after all; its task
+            # has been requeued or aborted
+            self.log.warning('discarding result from expired worker {!s}'.format(msg.src_id))
+            return
+        
         with self.message_validation(msg):
             assert msg.message == Message.RESULT
             assert isinstance(msg.payload, Result)
@@ -300,12 +346,22 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                         
         result = msg.payload
         
+        # The result arrives frozen; decode it before the task is forgotten, so that a
+        # result that cannot be unpickled here fails its future instead of this thread
+        try:
+            exception, traceback = result.exception, result.traceback
+            value = result.result if exception is None else None
+        except Exception as e:
+            self.log.error(str(e))
+            exception, traceback = e, None
+        
         future = self.futures.pop(result.task_id)
         del self.assigned_tasks[msg.src_id]
-        if result.exception is not None:
-            future._set_exception(result.exception, result.traceback)
+        self.requeued_task_ids.discard(result.task_id)
+        if exception is not None:
+            future._set_exception(exception, traceback)
         else:
-            future._set_result(result.result)
+            future._set_result(value)
             
     def handle_task_request(self, socket, msg):
         if not self.outgoing_tasks:
@@ -325,7 +381,8 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                 assert isinstance(msg.payload, dict)
             self.worker_information[msg.src_id] = msg.payload
         else:
-            self.worker_information[msg.src_id] = {}
+            # Keep what the worker told us when it identified itself
+            self.worker_information.setdefault(msg.src_id, {})
         
         try:
             self.worker_timeouts.reset(msg.src_id)
@@ -341,7 +398,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             except KeyError:
                 worker_description = str(expired_worker_id)
             
-            self.log.error('no contact from worker {}'.format(expired_worker_id, worker_description))
+            self.log.error('no contact from worker {}'.format(worker_description))
                
             self.remove_worker(expired_worker_id)            
                                         
@@ -351,11 +408,21 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         except KeyError:
             pass
         else:
-            self.log.error('aborting task {!r} running on expired worker {!s}'
-                           .format(expired_task, worker_id))
-            future = self.futures.pop(expired_task.task_id)
-            future._set_exception(ZMQWorkerMissing('worker running this task disappeared'))
+            if expired_task.task_id in self.requeued_task_ids:
+                # Lost a worker the second time around; don't let one task take down every worker
+                self.log.error('aborting task {!r} running on expired worker {!s}'
+                               .format(expired_task, worker_id))
+                self.requeued_task_ids.discard(expired_task.task_id)
+                future = self.futures.pop(expired_task.task_id)
+                future._set_exception(ZMQWorkerMissing('worker running this task disappeared'))
+            else:
+                self.log.warning('requeuing task {!r} from expired worker {!s}'
+                                 .format(expired_task, worker_id))
+                self.requeued_task_ids.add(expired_task.task_id)
+                self.outgoing_tasks.appendleft(expired_task)
         del self.worker_information[worker_id]
+        # Otherwise the stale timer would expire this worker again on every check
+        self.worker_timeouts.remove_timer(worker_id)
         
     def shutdown_clear_tasks(self):
         '''Abort pending tasks with error on shutdown.'''
@@ -366,19 +433,24 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             
     
     def comm_loop(self):
-        self.context = zmq.Context()
-        
+        # Socket options are deliberately left at libzmq defaults:
+        #  * libzmq always sets TCP_NODELAY on its TCP connections (there is no option for it)
+        #  * tasks are handed out one at a time in replies to worker requests, so the
+        #    send high-water mark on rr_socket never comes into play, and the (default 1000)
+        #    mark on ann_socket is far above the handful of coalesced announcements in flight
+        #  * every connecting socket (worker REQ, node DEALER) has exactly one peer, so
+        #    IMMEDIATE could not steer messages elsewhere; it would only make sends block
+        #    (instead of queueing) while the master is unreachable, bypassing recv timeouts
         rr_socket = self.context.socket(zmq.REP)
         ann_socket = self.context.socket(zmq.PUB)
-        
+
         for endpoint in (self.local_rr_endpoint, self.downstream_rr_endpoint):
             if endpoint: rr_socket.bind(endpoint)
             
         for endpoint in (self.local_ann_endpoint, self.downstream_ann_endpoint):
             if endpoint: ann_socket.bind(endpoint)
 
-        inproc_socket = self.context.socket(zmq.SUB)
-        inproc_socket.setsockopt(zmq.SUBSCRIBE,b'')
+        inproc_socket = self.context.socket(zmq.PULL)
         inproc_socket.bind(self.inproc_endpoint)
         
         poller = zmq.Poller()
@@ -399,7 +471,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
         
         try:
             # Send a master alive message immediately; it will get discarded if necessary
-            self.send_message(ann_socket, Message.MASTER_BEACON)
+            self.send_announcement(ann_socket, Message.MASTER_BEACON)
             
             while True:
                 # If a timer is already expired, next_expiration_in() will return 0, which
@@ -408,21 +480,34 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                 timeout = (timers.next_expiration_in() or 0.001)*1000
                 # Wake up every second to check for signals
                 timeout = min(timeout, 1000)
-                poll_results = dict(poller.poll(timeout))
+                poll_results = poller.poll(timeout)
                                 
-                if inproc_socket in poll_results:
-                    msgs = self.recv_all(inproc_socket,validate=False)
+                if (inproc_socket, zmq.POLLIN) in poll_results:
+                    msgs = self.recv_inproc_messages(inproc_socket,validate=False)
                     # Check for shutdown; do nothing else if shutdown is signalled
                     if Message.SHUTDOWN in (msg.message for msg in msgs):
                         self.log.debug('shutdown received')
                         break
-                    # Check for any other wake-up messages
+                    
+                    # Queue everything submitted since the last wake-up, then
+                    # announce it all at once
+                    n_outgoing = len(self.outgoing_tasks)
                     for msg in msgs:
                         if msg.message == Message.TASKS_AVAILABLE:
-                            self.send_message(ann_socket, Message.TASKS_AVAILABLE)
+                            self.outgoing_tasks.extend(msg.payload)
+                    if len(self.outgoing_tasks) > n_outgoing:
+                        self.send_announcement(ann_socket, Message.TASKS_AVAILABLE)
+                        timers.reset('tasks_avail')
                 
-                if rr_socket in poll_results:
+                if (rr_socket, zmq.POLLIN) in poll_results:
                     msg = self.recv_message(rr_socket)
+                    
+                    if msg is None:
+                        # Undecodable (and let through by validation_fail_action); a REP 
+                        # socket must still reply
+                        self.send_message(rr_socket, Message.NAK)
+                        continue
+                    
                     self.update_worker_information(msg)
                     
                     if msg.message == Message.TASK_REQUEST:
@@ -432,23 +517,26 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                     else:
                         self.send_ack(rr_socket, msg)
                         
-                    if self.worker_information:
+                    if self.worker_information and not peer_found:
                         peer_found = True
+                        # An expired timer would make every subsequent poll() return immediately
+                        timers.remove_timer('startup_timeout')
                 
                 if timers.expired('tasks_avail'):
                     if self.outgoing_tasks:
-                        self.send_message(ann_socket, Message.TASKS_AVAILABLE)
+                        self.send_announcement(ann_socket, Message.TASKS_AVAILABLE)
                     timers.reset('tasks_avail')
                     
                 if timers.expired('master_beacon'):
-                    self.send_message(ann_socket, Message.MASTER_BEACON)
+                    self.send_announcement(ann_socket, Message.MASTER_BEACON)
                     timers.reset('master_beacon')
                     
-                if peer_found and timers.expired('worker_timeout_check'):
-                    self.check_workers()
-                    if not self.worker_information:
-                        self.log.error('all workers disappeared; exiting')
-                        break
+                if timers.expired('worker_timeout_check'):
+                    if peer_found:
+                        self.check_workers()
+                        if not self.worker_information:
+                            self.log.error('all workers disappeared; exiting')
+                            break
                     timers.reset('worker_timeout_check')
                     
                 if not peer_found and timers.expired('startup_timeout'):
@@ -460,7 +548,7 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
                 
             # Post a shutdown message
             self.log.debug('sending shutdown on ann_socket')
-            self.send_message(ann_socket, Message.SHUTDOWN)            
+            self.send_announcement(ann_socket, Message.SHUTDOWN)            
             poller.unregister(inproc_socket)
             
             # Clear tasks
@@ -470,19 +558,26 @@ class ZMQWorkManager(ZMQCore,WorkManager,IsNode):
             # (clients will still timeout in these states if necessary)
             timers.add_timer('shutdown', self.shutdown_timeout)
             while not timers.expired('shutdown'):
-                poll_results = dict(poller.poll(self.shutdown_timeout / 10 * 1000))
-                if rr_socket in poll_results:
+                poll_results = poller.poll(self.shutdown_timeout / 10 * 1000)
+                if (rr_socket, zmq.POLLIN) in poll_results:
                     msg = self.recv_message(rr_socket)
-                    self.send_nak(rr_socket, msg)
+                    if msg is None:
+                        self.send_message(rr_socket, Message.NAK)
+                    else:
+                        self.send_nak(rr_socket, msg)
 
         finally:
+            self.close_inproc_sockets()
             self.context.destroy(linger=1)
             self.context = None
-            self.remove_ipc_endpoints()
+            self.release_ipc_endpoint(self.local_rr_endpoint)
+            self.release_ipc_endpoint(self.local_ann_endpoint)
     
     def startup(self):
         IsNode.startup(self)
-        super(ZMQWorkManager,self).startup()
+        self.context = zmq.Context(io_threads=self.io_threads)
+        self.comm_thread = threading.Thread(target=self.comm_loop)
+        self.comm_thread.start()
         
     def shutdown(self):
         self.signal_shutdown()
@@ -10,8 +10,10 @@ import logging
 from _ast import Break
 log = logging.getLogger(__name__)
 
-from .core import ZMQCore, Message, ZMQWMTimeout, PassiveMultiTimer, Task, Result, TIMEOUT_MASTER_BEACON
-import threading, multiprocessing, os, signal
+from .core import ZMQCore, Message, ZMQWMTimeout, ZMQWorkerMissing, PassiveMultiTimer, Task, Result, TIMEOUT_MASTER_BEACON
+from .core import readable
+import threading, multiprocessing, os, signal, time
+from pickle import UnpicklingError
 from contextlib import contextmanager
 
 
@@ -37,13 +39,19 @@ class ZMQWorker(ZMQCore):
         self.master_id = None
         self.identified = False
         
-        # The task currently being processed
+        # The task currently being processed, and when it was handed to the executor
         self.pending_task = None
+        self.pending_task_started = None
         
         # Executor process
         
         self.shutdown_timeout = 5.0 # Five second wait between shutdown message and SIGINT and SIGINT and SIGKILL
         self.executor_process = None
+        self.process_index = None
+        
+        # Longest time (in seconds) a task may run before its executor is killed and the
+        # task reported as failed; None for no limit. Checked every worker beacon period.
+        self.task_timeout = None
 
     @property
     def is_master(self):
@@ -51,6 +59,9 @@ class ZMQWorker(ZMQCore):
 
                     
     def update_master_info(self, msg):
+        if msg is None:
+            # A reply that could not be decoded (see recv_message()) tells us nothing
+            return
         if self.master_id is None:
             self.master_id = msg.master_id
         self.timers.reset(TIMEOUT_MASTER_BEACON)
@@ -61,6 +72,49 @@ class ZMQWorker(ZMQCore):
         self.recv_ack(rr_socket,timeout=self.master_beacon_period*self.timeout_factor*1000)
         self.identified = True
         
+    def send_beacon(self, rr_socket):
+        '''Let the master know we are still alive, even while a long task is running.'''
+        if self.master_id is None or self.timers.expired(TIMEOUT_MASTER_BEACON): return
+        elif not self.identified:
+            self.identify(rr_socket)
+        else:
+            task_id = self.pending_task.task_id if self.pending_task is not None else None
+            self.send_message(rr_socket, Message.WORKER_BEACON, payload=task_id)
+            reply = self.recv_ack(rr_socket,timeout=self.master_beacon_period*self.timeout_factor*1000)
+            self.update_master_info(reply)
+        
+    def check_executor(self, rr_socket, result_socket):
+        '''Restart the executor if it has died, or if it has been running the pending task
+        for longer than ``task_timeout``. The pending task, if any, is reported to the master
+        as failed.'''
+        if readable(result_socket):
+            # The pending task finished; handle_result() will take care of it
+            return
+        
+        if not self.executor_process.is_alive():
+            exception = ZMQWorkerMissing('executor process died (exit code {!s}) while running this task'
+                                         .format(self.executor_process.exitcode))
+        elif (self.pending_task is not None and self.task_timeout is not None 
+              and time.time() - self.pending_task_started > self.task_timeout):
+            exception = ZMQWMTimeout('task exceeded the time limit of {!s} s'.format(self.task_timeout))
+            # Signals are ignored by the executor (see install_signal_handlers())
+            self.executor_process.kill()
+            self.executor_process.join()
+        else:
+            return
+        
+        self.log.error('restarting executor: {!s}'.format(exception))
+        self.start_executor()
+        
+        if self.pending_task is not None and self.master_id is not None:
+            result = Result(self.pending_task.task_id, exception=exception)
+            self.pending_task = None
+            self.send_message(rr_socket, Message.RESULT, result)
+            reply = self.recv_ack(rr_socket, timeout=self.master_beacon_period*self.timeout_factor*1000)
+            self.update_master_info(reply)
+        else:
+            self.pending_task = None
+        
     def request_task(self, rr_socket, task_socket):
         if self.master_id is None: return
         elif self.pending_task is not None: return
@@ -69,7 +123,7 @@ class ZMQWorker(ZMQCore):
             self.send_message(rr_socket, Message.TASK_REQUEST)
             reply = self.recv_message(rr_socket,timeout=self.master_beacon_period*self.timeout_factor*1000)
             self.update_master_info(reply)
-            if reply.message == Message.NAK:
+            if reply is None or reply.message == Message.NAK:
                 # No task available
                 return 
             else:
@@ -77,6 +131,7 @@ class ZMQWorker(ZMQCore):
                     assert isinstance(reply.payload, Task)
                     task = reply.payload
                 self.pending_task = task
+                self.pending_task_started = time.time()
                 self.send_message(task_socket, Message.TASK, task)                       
             
     def handle_reconfigure_timeout(self, msg, timers):
@@ -88,6 +143,11 @@ class ZMQWorker(ZMQCore):
         
     def handle_result(self, result_socket, rr_socket):
         msg = self.recv_message(result_socket)
+        if msg is None:
+            if self.pending_task is None: return
+            # Still report the pending task, so that it does not hang
+            msg = Message(Message.RESULT, Result(self.pending_task.task_id, 
+                                                 exception=UnpicklingError('could not decode result from executor')))
         with self.message_validation(msg):
             assert msg.message == Message.RESULT
             assert isinstance(msg.payload, Result)
@@ -106,8 +166,7 @@ class ZMQWorker(ZMQCore):
 
         ann_socket = self.context.socket(zmq.SUB)
         ann_socket.setsockopt(zmq.SUBSCRIBE,b'')
-        inproc_socket = self.context.socket(zmq.SUB)
-        inproc_socket.setsockopt(zmq.SUBSCRIBE,b'')
+        inproc_socket = self.context.socket(zmq.PULL)
         
         task_socket = self.context.socket(zmq.PUSH)
         result_socket = self.context.socket(zmq.PULL)
@@ -132,12 +191,16 @@ class ZMQWorker(ZMQCore):
             poller.register(inproc_socket, zmq.POLLIN)
             poller.register(result_socket, zmq.POLLIN)
             
+            # Reused (cleared) on each pass through the loop
+            announcements = []
+            messages_by_tag = {}
+            
             timers.reset()
             while True:
                 # If a timer is already expired, next_expiration_in() will return 0, which
                 # zeromq interprets as infinite wait; so instead we select a 1 ms wait in this
                 # case.
-                poll_results = dict(poller.poll((timers.next_expiration_in() or 0.001)*1000))
+                poll_results = poller.poll((timers.next_expiration_in() or 0.001)*1000)
                 
                 if poll_results and not peer_found:
                     timers.remove_timer('startup_timeout')
@@ -145,20 +208,20 @@ class ZMQWorker(ZMQCore):
                     timers.change_duration(TIMEOUT_MASTER_BEACON, self.master_beacon_period*self.timeout_factor)
                     timers.reset(TIMEOUT_MASTER_BEACON)
                 
-                announcements = []   
+                announcements.clear()
+                messages_by_tag.clear()
                 
                 # Check for internal messages first
-                if inproc_socket in poll_results:
-                    announcements.extend(self.recv_all(inproc_socket))
+                if (inproc_socket, zmq.POLLIN) in poll_results:
+                    announcements.extend(self.recv_inproc_messages(inproc_socket))
           
                 # Process announcements
-                if ann_socket in poll_results:
+                if (ann_socket, zmq.POLLIN) in poll_results:
                     announcements.extend(self.recv_all(ann_socket))
                     
                 #announcements = Message.coalesce_announcements(announcements)
                 #self.log.debug('received {:d} announcements'.format(len(announcements)))
                 
-                messages_by_tag = {}
                 for msg in announcements:
                     messages_by_tag.setdefault(msg.message, list()).append(msg)
                     
@@ -171,13 +234,15 @@ class ZMQWorker(ZMQCore):
                 elif Message.MASTER_BEACON in messages_by_tag:
                     self.update_master_info(messages_by_tag[Message.MASTER_BEACON][0])
                     
-                if self.master_id is not None and timers.expired('worker_beacon'):
-                    self.identify(rr_socket)
+                if timers.expired('worker_beacon'):
+                    # The beacon only shows that this thread is alive, so check on the executor too
+                    self.check_executor(rr_socket, result_socket)
+                    self.send_beacon(rr_socket)
                     timers.reset('worker_beacon')
                 
                 # Handle results, so that we clear ourselves of completed tasks
                 # before asking for more
-                if result_socket in poll_results:
+                if (result_socket, zmq.POLLIN) in poll_results:
                     self.handle_result(result_socket, rr_socket)
                     # immediately request another task if available
                     if not timers.expired(TIMEOUT_MASTER_BEACON):
@@ -192,8 +257,6 @@ class ZMQWorker(ZMQCore):
                             self.handle_reconfigure_timeout(msg, timers)
                     elif tag == Message.TASKS_AVAILABLE:
                         self.request_task(rr_socket,task_socket)      
-                        
-                del announcements, messages_by_tag
             
                 if timers.expired(TIMEOUT_MASTER_BEACON):
                     self.log.error('no contact from master; shutting down')
@@ -211,18 +274,26 @@ class ZMQWorker(ZMQCore):
         finally:
             self.shutdown_executor()
             self.executor_process.join()
+            self.close_inproc_sockets()
             self.context.destroy(linger=1)
             self.context = None
-            self.remove_ipc_endpoints()
+            # Only remove our own endpoints; those inherited from a parent process
+            # still belong to it
+            self.release_ipc_endpoint(self.task_endpoint)
+            self.release_ipc_endpoint(self.result_endpoint)
             
     def shutdown_executor(self):
-        if self.context is not None:
+        if self.context is not None and self.executor_process.is_alive():
             try:
                 self.log.debug('sending shutdown task to executor')
                 task_socket = self.context.socket(zmq.PUSH)
                 task_socket.connect(self.task_endpoint)
                 self.send_message(task_socket, Message.SHUTDOWN)
-                task_socket.close(linger=1)
+                # close() returns immediately regardless; the linger period is how long
+                # libzmq keeps trying to deliver the message in the background. It must 
+                # outlast the (asynchronous) connect, or the executor never hears of the 
+                # shutdown and is killed after shutdown_timeout instead.
+                task_socket.close(linger=int(self.shutdown_timeout*1000))
             except:
                 pass
 
@@ -256,11 +327,15 @@ class ZMQWorker(ZMQCore):
         for sig in signals:
             signal.signal(sig, signal.SIG_IGN)
 
-    def startup(self, process_index=None):
-        self.install_signal_handlers()
+    def start_executor(self):
         executor = ZMQExecutor(self.task_endpoint, self.result_endpoint)
-        self.executor_process = multiprocessing.Process(target = executor.startup, args=(process_index,))
+        self.executor_process = multiprocessing.Process(target = executor.startup, args=(self.process_index,))
         self.executor_process.start()
+
+    def startup(self, process_index=None):
+        self.install_signal_handlers()
+        self.process_index = process_index
+        self.start_executor()
         self.context = zmq.Context()
         self.comm_thread = threading.Thread(target=self.comm_loop)
         self.comm_thread.start()
@@ -298,9 +373,13 @@ class ZMQExecutor(ZMQCore):
                 except ZMQWMTimeout:
                     continue
                 else:
-                    if msg.message == Message.TASK:
+                    if msg is None:
+                        # Undecodable; the worker's task_timeout, if any, recovers the task
+                        continue
+                    elif msg.message == Message.TASK:
                         task = msg.payload
-                        result = task.execute()
+                        # Frozen, so that the worker can pass it on without unpickling it
+                        result = task.execute().freeze()
                         self.send_message(result_socket, Message.RESULT, result)
                     elif msg.message == Message.SHUTDOWN:
                         break